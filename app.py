@@ -2,11 +2,14 @@ import os
 import sys
 import threading
 import subprocess
-from flask import Flask, render_template, redirect, url_for, send_from_directory, request, jsonify, flash
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.executors.pool import ThreadPoolExecutor, ProcessPoolExecutor
+import time
+from collections import deque
+import numpy as np
+from flask import Flask, render_template, redirect, url_for, send_from_directory, request, jsonify, flash, Response
+from flask.json.provider import JSONProvider
+import orjson
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
-from config_loader import REGISTER_CONFIG # Import the loaded config
+from config_loader import REGISTER_CONFIG, CACHED_DEFINITIONS_JSON, DEFINITIONS_ETAG, CACHE_PATH as CONFIG_CACHE_PATH # Import the loaded config
 from modbus_client import read_modbus_data
 from datetime import datetime, timedelta, timezone # MODIFIED: timezone import already present, UTC removed as gmt_plus_8 will be used
 from timezone_config import set_timezone # ADDED: Import set_timezone
@@ -14,8 +17,25 @@ from mqtt_client import upload_to_mqtt as upload_to_cloud
 import logging # Add logging import
 import yaml # Add this import
 
+# Use the libyaml C extension when available (matches config_loader)
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, so jsonify/request.json use the
+    C serializer instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key'
+app.json = OrjsonProvider(app)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,26 +43,58 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # --- Add API endpoint for register definitions ---
 @app.route('/api/registers/definitions')
 def get_register_definitions():
-    # Return the processed configuration relevant for the frontend
-    # Filter or structure as needed, here returning groups and raw list
-    definitions = {
-        "registers": REGISTER_CONFIG.get("raw", []),
-        "groups": REGISTER_CONFIG.get("by_group", {}),
-        "views": REGISTER_CONFIG.get("by_view", {})
-        # Add other processed parts of the config if needed by frontend
-    }
-    return jsonify(definitions)
+    # The definitions are serialized once at config-load time; the response
+    # here is just the cached bytes plus an mtime-based ETag for 304s
+    if request.headers.get('If-None-Match') == DEFINITIONS_ETAG:
+        return Response(status=304, headers={'ETag': DEFINITIONS_ETAG})
+    return Response(CACHED_DEFINITIONS_JSON, mimetype='application/json',
+                    headers={'ETag': DEFINITIONS_ETAG})
 # --- Endpoint added ---
 
 # ... (Background task setup)
-collect_sensor_lock = threading.Lock()
+
+# --- MQTT upload batching ---
+# Samples are buffered and flushed as one publish when either the batch fills
+# or the maximum delay elapses. At the default 5s tick the delay flush fires
+# every tick (unchanged behaviour); sub-second intervals get real batching.
+MQTT_BATCH_SIZE = int(os.getenv('MQTT_BATCH_SIZE', '50'))
+MQTT_BATCH_MS = int(os.getenv('MQTT_BATCH_MS', '500'))
+_pending_uploads = deque(maxlen=MQTT_BATCH_SIZE)
+_last_flush = time.monotonic()
+
+# --- Delta publishing state ---
+# Most registers are stable between 5s ticks, so only changed values are
+# published; every MQTT_FULL_EVERY ticks a full snapshot goes out so
+# subscribers that missed a delta re-sync.
+MQTT_FULL_EVERY = int(os.getenv('MQTT_FULL_EVERY', '60'))
+_last_sent = {}
+_tick_count = 0
+_MISSING = object() # Distinguishes "never sent" from a stored None
+
+# Preallocated scaling output buffer, reused every tick (the upload loop is
+# single-threaded, so no tick can observe another's values)
+_N_REGISTERS = len(REGISTER_CONFIG['name_order'])
+_scaled_buf = np.empty(_N_REGISTERS, dtype=np.float64)
+
+def _flush_pending_uploads():
+    """Publish all buffered samples as a single MQTT upload."""
+    global _last_flush
+    batch = list(_pending_uploads)
+    _pending_uploads.clear()
+    _last_flush = time.monotonic()
+    if not batch:
+        return True
+    # A single sample keeps the original flat payload shape for subscribers
+    payload = batch[0] if len(batch) == 1 else batch
+    return upload_to_cloud(payload)
 
 def process_and_upload_sensor_data():
-    """Read Modbus data, process it using register_config.yaml, and upload to MQTT."""
-    if not collect_sensor_lock.acquire(blocking=False):
-        logging.warning("Could not acquire sensor data lock, process already running.")
-        return
+    """Read Modbus data, process it using register_config.yaml, and upload to MQTT.
 
+    Only ever called from the single upload-loop thread, so ticks are
+    intrinsically serial and no overlap lock is needed.
+    """
+    global _tick_count
     try:
         logging.debug("Reading Modbus data and processing for MQTT upload...")
         
@@ -52,63 +104,69 @@ def process_and_upload_sensor_data():
             logging.warning("No Modbus data available for processing")
             return
 
-        # Process data with scaling (similar to live_data.py)
-        processed_data = {}
+        # Process data with scaling (vectorized against the precomputed scale factors)
         current_time_app_tz = datetime.now(set_timezone)
-        
-        for name, raw_value in raw_data.items():
-            if raw_value is None:
-                processed_data[name] = None
-                continue
-
-            reg_info = REGISTER_CONFIG['by_name'].get(name)
-            if reg_info:
-                # Apply scaling if defined
-                scale = reg_info.get('scale')
-                if scale is not None:
-                    try:
-                        processed_value = float(raw_value) * float(scale)
-                    except (ValueError, TypeError):
-                        logging.warning(f"Could not apply scale to {name}: {raw_value}")
-                        processed_value = raw_value
-                else:
-                    processed_value = raw_value
-                processed_data[name] = processed_value
-            else:
-                processed_data[name] = raw_value
+
+        name_order = REGISTER_CONFIG['name_order']
+        raw_arr = np.fromiter(
+            (v if (v := raw_data.get(name)) is not None else np.nan for name in name_order),
+            dtype=np.float64, count=_N_REGISTERS)
+        np.multiply(raw_arr, REGISTER_CONFIG['scale_vector'], out=_scaled_buf)
+        # NaN marks registers missing from this read; keep them as None for subscribers
+        processed_data = {
+            name: (None if value != value else value)
+            for name, value in zip(name_order, _scaled_buf.tolist())
+        }
+
+        # Reduce to a delta against the last published values, except on the
+        # periodic full-snapshot tick
+        _tick_count += 1
+        full_snapshot = processed_data
+        if _tick_count % MQTT_FULL_EVERY != 0:
+            processed_data = {k: v for k, v in full_snapshot.items()
+                              if _last_sent.get(k, _MISSING) != v}
+        _last_sent.update(full_snapshot)
+
+        # Nothing changed since the last tick: skip serialization and publish
+        # entirely. The periodic full snapshot doubles as the heartbeat.
+        if not processed_data:
+            logging.debug("No sensor changes this tick; skipping MQTT upload")
+            return
 
         # Add timestamp and device ID
         processed_data['timestamp'] = current_time_app_tz.isoformat()
         device_id = os.getenv('CLOUD_DEVICE_ID', 'vflow_sensor_client')
         processed_data['device_id'] = device_id
 
-        # Upload to MQTT
-        upload_success = upload_to_cloud(processed_data)
-        if upload_success:
-            logging.debug("📤 Data processed and uploaded to MQTT successfully")
-        else:
-            logging.warning("⚠️ Failed to upload processed data to MQTT")
+        # Buffer for MQTT upload; flush when the batch fills or the delay elapses
+        _pending_uploads.append(processed_data)
+        if len(_pending_uploads) >= MQTT_BATCH_SIZE or (time.monotonic() - _last_flush) * 1000 >= MQTT_BATCH_MS:
+            if _flush_pending_uploads():
+                logging.debug("📤 Data processed and uploaded to MQTT successfully")
+            else:
+                logging.warning("⚠️ Failed to upload processed data to MQTT")
                 
     except Exception as e:
         logging.error(f"Error in process_and_upload_sensor_data: {e}", exc_info=True)
-    finally:
-        collect_sensor_lock.release()
 
-# ... (Scheduler setup remains the same)
-executors = {
-    'default': ThreadPoolExecutor(1) # Only allow 1 thread at a time
-}
+# --- Upload loop setup ---
+# The APScheduler ThreadPoolExecutor(1) job plus overlap lock amounted to a
+# serial pipeline with per-tick scheduler overhead; a dedicated daemon thread
+# running a plain loop is serial by construction.
+_upload_stop = threading.Event()
+
+def _upload_loop(upload_interval):
+    while not _upload_stop.wait(upload_interval):
+        process_and_upload_sensor_data()
 
 def start_scheduler():
     # Get data collection and upload interval from environment variable (default: 5 seconds)
-    upload_interval = int(os.getenv('DATA_UPLOAD_INTERVAL', '5'))
-    
-    scheduler = BackgroundScheduler(executors=executors)
-    # Schedule data processing and MQTT upload (configurable interval)
     # Change DATA_UPLOAD_INTERVAL in .env file to modify frequency
-    scheduler.add_job(process_and_upload_sensor_data, 'interval', seconds=upload_interval, id='process_upload_job', replace_existing=True)
-    scheduler.start()
-    logging.info(f"Background scheduler started with data processing and MQTT upload every {upload_interval}s.")
+    upload_interval = int(os.getenv('DATA_UPLOAD_INTERVAL', '5'))
+
+    threading.Thread(target=_upload_loop, args=(upload_interval,),
+                     name='sensor-upload', daemon=True).start()
+    logging.info(f"Background upload loop started with data processing and MQTT upload every {upload_interval}s.")
 
 @app.route('/favicon.ico')
 def favicon():
@@ -133,8 +191,14 @@ def settings():
 def serve_static(filename):
     return send_from_directory('static', filename)
 
+# Raw YAML document cached across /api/set-modbus-config POSTs so repeated
+# updates patch in memory instead of re-parsing the whole file each time
+_config_doc = None
+_config_doc_lock = threading.Lock()
+
 @app.route('/api/set-modbus-config', methods=['POST'])
 def set_modbus_config():
+    global _config_doc
     data = request.json
     ip = data.get('ip')
     port = data.get('port')
@@ -145,17 +209,30 @@ def set_modbus_config():
     config_path = os.path.join(app.root_path, 'register_config.yaml')
 
     try:
-        with open(config_path, 'r') as f:
-            config_data = yaml.safe_load(f)
+        with _config_doc_lock:
+            if _config_doc is None:
+                with open(config_path, 'r') as f:
+                    _config_doc = yaml.load(f, Loader=SafeLoader)
 
-        if 'modbus' not in config_data or not isinstance(config_data['modbus'], dict):
-            config_data['modbus'] = {} # Ensure modbus section exists
+            if 'modbus' not in _config_doc or not isinstance(_config_doc['modbus'], dict):
+                _config_doc['modbus'] = {} # Ensure modbus section exists
 
-        config_data['modbus']['ip'] = ip
-        config_data['modbus']['port'] = int(port) # Ensure port is an integer
+            _config_doc['modbus']['ip'] = ip
+            _config_doc['modbus']['port'] = int(port) # Ensure port is an integer
 
-        with open(config_path, 'w') as f:
-            yaml.dump(config_data, f, sort_keys=False)
+            # Write atomically: dump to a sibling temp file, then replace, so a
+            # crash mid-write can never leave a truncated config behind
+            tmp_path = config_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                yaml.dump(_config_doc, f, Dumper=SafeDumper, sort_keys=False)
+            os.replace(tmp_path, config_path)
+
+            # The pickled processed config is now stale; drop it so the next
+            # start re-parses the updated YAML
+            try:
+                os.remove(CONFIG_CACHE_PATH)
+            except OSError:
+                pass
 
         logging.info(f"Updated Modbus config in register_config.yaml: IP={ip}, Port={port}")
         flash("Modbus configuration updated in register_config.yaml. Please restart the application for changes to take full effect.", "success")
@@ -166,8 +243,16 @@ def set_modbus_config():
         return jsonify({"error": f"Failed to update configuration file: {e}"}), 500
 
 if __name__ == '__main__':
-    start_scheduler()
+    # Only enable the dev server's debugger/reloader when explicitly in
+    # development; the reloader forks a child process, importing everything
+    # (including the Modbus client) twice at startup.
+    debug = os.getenv('FLASK_ENV') == 'development'
+
+    # Under the reloader only the serving child (WERKZEUG_RUN_MAIN) should
+    # start the upload loop, or it runs twice
+    if not debug or os.getenv('WERKZEUG_RUN_MAIN') == 'true':
+        start_scheduler()
     # Use host='0.0.0.0' to make it accessible on the network
-    app.run(debug=True, host='0.0.0.0', port=5000) # Added host and port
+    app.run(debug=debug, use_reloader=debug, host='0.0.0.0', port=int(os.getenv('PORT', '5000')))
 
 
@@ -1,17 +1,110 @@
 # filepath: c:\\Users\\LeeJR\\Desktop\\VFlow\\Webpage\\V4\\api\\config_loader.py
 import yaml
 import os
-from collections import defaultdict
+import pickle
+import numpy as np
+import orjson
+
+# Prefer the libyaml C extension - roughly an order of magnitude faster than
+# the pure-Python loader. Fall back when PyYAML was built without it.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'register_config.yaml') # Path relative to this file
+CACHE_PATH = CONFIG_PATH + '.pkl' # Pickled processed config, keyed on the YAML's mtime
+CACHE_SCHEMA_VERSION = 2 # Bump whenever load_register_config changes the config layout
+JSON_CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'register_config.json') # Optional deploy-time conversion (scripts/yaml_to_json.py)
+
+# dataType strings that mark a register as a signed 16-bit value
+SIGNED_DATA_TYPES = {'int16', 'sint16', 'signed', 'short', 'signed_short', 'signed int16'}
+
+# Modbus read-range coalescing parameters
+MAX_RANGE_LENGTH = 125 # Protocol limit for a single read_holding_registers request
+RANGE_GAP_THRESHOLD = 4 # Bridge gaps of up to this many unused registers (cheaper than an extra request)
+
+def _compute_read_ranges(addresses):
+    """Coalesce register addresses into contiguous (start, count) read ranges.
+
+    Sparse address layouts are merged into as few ranges as possible:
+    gaps of up to RANGE_GAP_THRESHOLD unused registers are read and discarded
+    (cheaper than a second TCP round-trip), and each range is capped at
+    MAX_RANGE_LENGTH registers per the Modbus protocol limit.
+    """
+    if not addresses:
+        return []
+
+    sorted_addresses = sorted(addresses)
+    ranges = []
+    start = prev = sorted_addresses[0]
+    for addr in sorted_addresses[1:]:
+        if (addr - prev) > RANGE_GAP_THRESHOLD or (addr - start + 1) > MAX_RANGE_LENGTH:
+            ranges.append((start, prev - start + 1))
+            start = addr
+        prev = addr
+    ranges.append((start, prev - start + 1))
+    return ranges
+
+def _load_cached_config():
+    """Return the pickled processed config if it is newer than the YAML, else None.
+
+    The pickle stores (CACHE_SCHEMA_VERSION, config); anything else - including
+    a cache written by an older revision with a different config layout - is
+    treated as a miss, since the mtime check alone would keep an outdated
+    format "fresh" forever.
+    """
+    try:
+        if os.path.getmtime(CACHE_PATH) >= os.path.getmtime(CONFIG_PATH):
+            with open(CACHE_PATH, 'rb') as f:
+                cached = pickle.load(f)
+            if (isinstance(cached, tuple) and len(cached) == 2
+                    and cached[0] == CACHE_SCHEMA_VERSION):
+                return cached[1]
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass # Missing or stale/corrupt cache - fall back to parsing the YAML
+    return None
+
+def _write_cached_config(config):
+    """Best-effort write of the processed config pickle next to the YAML."""
+    try:
+        with open(CACHE_PATH, 'wb') as f:
+            pickle.dump((CACHE_SCHEMA_VERSION, config), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        # Read-only deployments are fine - we just pay the parse cost each start
+        print(f"⚠️ Could not write config cache {CACHE_PATH}: {e}")
+
+def _read_raw_config():
+    """Read the raw config document, preferring the JSON conversion when fresh.
+
+    register_config.yaml stays the authoring format; scripts/yaml_to_json.py
+    converts it at deploy time so startup can skip the YAML parser entirely.
+    The JSON is only trusted while it is at least as new as the YAML.
+    """
+    try:
+        if os.path.getmtime(JSON_CONFIG_PATH) >= os.path.getmtime(CONFIG_PATH):
+            with open(JSON_CONFIG_PATH, 'rb') as f:
+                return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        pass # No JSON conversion (or stale/corrupt) - parse the YAML below
+
+    with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+        return yaml.load(f, Loader=SafeLoader)
 
 def load_register_config():
-    """Loads and processes the register_config.yaml configuration."""
+    """Loads and processes the register_config.yaml configuration.
+
+    YAML parsing dominates import time, so the fully-processed result is
+    cached as a pickle sidecar and reused while the YAML is unchanged.
+    """
     if not os.path.exists(CONFIG_PATH):
         raise FileNotFoundError(f"Configuration file not found: {CONFIG_PATH}")
 
-    with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-        config_data = yaml.safe_load(f)
+    cached = _load_cached_config()
+    if cached is not None:
+        return cached
+
+    config_data = _read_raw_config()
 
     if not config_data:
         raise ValueError("Configuration file is empty or invalid.")
@@ -26,36 +119,65 @@ def load_register_config():
 
 
     # --- Process and index the configuration for easier access ---
+    # All indexes (by name, address, group and ui.view) plus the address
+    # bounds are built in a single pass over the register list; setdefault on
+    # plain dicts avoids the defaultdict-to-dict copies the old multi-pass
+    # version needed.
+    registers_by_name = {}
+    registers_by_address = {}
+    registers_by_group = {}
+    registers_by_view = {}
+    min_address = max_address = None
 
-    # Map name to register info
-    registers_by_name = {reg['name']: reg for reg in registers}
+    for reg in registers:
+        address = reg['address']
+        registers_by_name[reg['name']] = reg
+        registers_by_address[address] = reg
 
-    # Map address to register info
-    registers_by_address = {reg['address']: reg for reg in registers}
+        if min_address is None or address < min_address:
+            min_address = address
+        if max_address is None or address > max_address:
+            max_address = address
 
-    # Group registers by their 'group' key
-    registers_by_group = defaultdict(list)
-    for reg in registers:
         if 'group' in reg:
-            registers_by_group[reg['group']].append(reg)
+            registers_by_group.setdefault(reg['group'], []).append(reg)
 
-    # Group registers by their 'ui.view' key
-    registers_by_view = defaultdict(list)
-    for reg in registers:
         views = reg.get('ui', {}).get('view', [])
         if isinstance(views, str): # Handle single string view
             views = [views]
         for view in views:
-            registers_by_view[view].append(reg)
-
-
-    # Find the maximum address to determine read range (optional, can be refined)
-    max_address = 0
-    min_address = 0 # Initialize min_address
-    if registers:
-        addresses = [reg['address'] for reg in registers]
-        max_address = max(addresses)
-        min_address = min(addresses) # Calculate minimum address
+            registers_by_view.setdefault(view, []).append(reg)
+
+
+    # Address bounds were tracked in the indexing pass; default to 0 when no
+    # registers are configured
+    if min_address is None:
+        min_address = max_address = 0
+
+    # Parallel arrays for vectorized scaling in the per-tick hot path:
+    # scale_vector[i] is the factor for name_order[i] (1.0 when unscaled)
+    name_order = [reg['name'] for reg in registers]
+    scale_vector = np.array(
+        [float(reg['scale']) if reg.get('scale') is not None else 1.0 for reg in registers],
+        dtype=np.float64)
+
+    # Struct-of-arrays view of the registers: parallel arrays indexed by each
+    # register's position in name_order, so the per-tick hot paths (sign
+    # conversion, scaling, address mapping) can run as bulk NumPy ops instead
+    # of walking per-register dicts. by_name/by_address stay for everything else.
+    register_count = len(registers)
+    soa = {
+        'names': name_order,
+        'name_to_idx': {name: i for i, name in enumerate(name_order)},
+        'addresses': np.fromiter((reg['address'] for reg in registers), dtype=np.int32, count=register_count),
+        'scales': scale_vector,
+        'is_signed': np.fromiter(
+            ((reg.get('dataType') or '').lower() in SIGNED_DATA_TYPES for reg in registers),
+            dtype=bool, count=register_count)
+    }
+    # Offsets of each register in the contiguous read buffer spanning
+    # min_address..max_address, so the per-tick gather needs no arithmetic
+    soa['positions'] = soa['addresses'] - min_address
 
     # Add buffer if needed, e.g., read one extra register if max address is 148
     # total_register_count = max_address + 1 if max_address > 0 else 0 # This might not be accurate if addresses are sparse
@@ -63,22 +185,40 @@ def load_register_config():
     total_register_count = (max_address - min_address + 1) if registers else 0
 
     # --- Return a structured dictionary ---
-    return {
+    config = {
         'raw': registers,
         'by_name': registers_by_name,
         'by_address': registers_by_address,
-        'by_group': dict(registers_by_group), # Convert defaultdict back to dict
-        'by_view': dict(registers_by_view),   # Convert defaultdict back to dict
+        'by_group': registers_by_group,
+        'by_view': registers_by_view,
         'max_address': max_address,
         'min_address': min_address, # Add min_address
+        'read_ranges': _compute_read_ranges(registers_by_address.keys()), # Coalesced (start, count) batches
+        'name_order': name_order, # Register names in config order
+        'scale_vector': scale_vector, # Per-register scale factors aligned with name_order
+        'soa': soa, # Struct-of-arrays layout for the vectorized hot paths
         'total_register_count': total_register_count, # Use the range-based count
         'modbus_ip': modbus_config.get('ip'), # Add Modbus IP
         'modbus_port': modbus_config.get('port') # Add Modbus Port
     }
 
+    _write_cached_config(config)
+    return config
+
 # --- Load the configuration ONCE when the module is imported ---
 REGISTER_CONFIG = load_register_config()
 
+# --- Pre-serialized /api/registers/definitions response ---
+# REGISTER_CONFIG is immutable after import, so the JSON bytes are built once
+# here instead of on every request. The ETag is keyed on the YAML's mtime so
+# clients can revalidate with a cheap 304.
+CACHED_DEFINITIONS_JSON = orjson.dumps({
+    "registers": REGISTER_CONFIG['raw'],
+    "groups": REGISTER_CONFIG['by_group'],
+    "views": REGISTER_CONFIG['by_view']
+})
+DEFINITIONS_ETAG = f'"{int(os.path.getmtime(CONFIG_PATH))}"'
+
 # --- Optional: Print loaded config details for verification ---
 # print(f"✅ Register config loaded. Min Addr: {REGISTER_CONFIG['min_address']}, Max Addr: {REGISTER_CONFIG['max_address']}, Count: {REGISTER_CONFIG['total_register_count']}")
 # print(f"   Registers by name: {list(REGISTER_CONFIG['by_name'].keys())}")
@@ -1,5 +1,10 @@
 import os
 import sys
+import atexit
+import functools
+import socket
+import threading
+import numpy as np
 from pymodbus.client import ModbusTcpClient
 from datetime import datetime
 from pymodbus.exceptions import ConnectionException
@@ -17,6 +22,8 @@ from config_loader import REGISTER_CONFIG
 
 MODBUS_IP = REGISTER_CONFIG.get('modbus_ip', "192.168.0.33") # Get from loaded config
 MODBUS_PORT = int(REGISTER_CONFIG.get('modbus_port', 1502)) # Get from loaded config
+MODBUS_UNIT_ID = int(os.getenv('MODBUS_UNIT_ID', '1')) # Slave/unit id for all reads
+MODBUS_TIMEOUT = float(os.getenv('MODBUS_TIMEOUT', '3')) # Per-request timeout in seconds
 
 # --- Get read parameters from loaded config ---
 # TOTAL_REGISTER_COUNT = int(os.getenv("MODBUS_VARIABLE_COUNT", "156")) # Replaced by config
@@ -24,41 +31,96 @@ MODBUS_PORT = int(REGISTER_CONFIG.get('modbus_port', 1502)) # Get from loaded co
 MAX_ADDRESS_TO_READ = REGISTER_CONFIG['max_address'] # Useful for knowing the highest address needed
 MIN_ADDRESS_TO_READ = REGISTER_CONFIG['min_address'] # Get the minimum address
 
-# Max registers per read request (adjust if needed, 125 is a common limit)
-MAX_READ_COUNT = 64
+# Coalesced (start, count) read batches precomputed from the configured addresses.
+# Sparse layouts produce one request per contiguous run instead of scanning the
+# full MIN..MAX span in fixed-size chunks.
+READ_RANGES = REGISTER_CONFIG['read_ranges']
+
+# Struct-of-arrays register layout (see config_loader) for the vectorized
+# sign conversion and name mapping below.
+_SOA = REGISTER_CONFIG['soa']
+_BUFFER_LEN = (MAX_ADDRESS_TO_READ - MIN_ADDRESS_TO_READ + 1) if _SOA['names'] else 0
 
 def get_modbus_client():
     """Use the globally defined Modbus configuration."""
     #print(f"Attempting Modbus connection to {MODBUS_IP}:{MODBUS_PORT}") # Use global constants if uncommented
-    return ModbusTcpClient(MODBUS_IP, port=MODBUS_PORT) # Use global constants
+    return ModbusTcpClient(MODBUS_IP, port=MODBUS_PORT, timeout=MODBUS_TIMEOUT) # Use global constants
+
+# --- Persistent client shared across scheduler ticks ---
+# Opening and closing a TCP connection for every read is pure overhead at a
+# 5-second polling interval; keep one client alive and reconnect only when
+# the socket has dropped.
+_client = None
+_client_lock = threading.Lock()
+_read_fn = None # read_holding_registers partial with the slave id pre-bound
+
+def _get_connected_read_fn():
+    """Return the read callable for the shared client, (re)connecting if necessary.
+
+    The slave/unit argument is bound once per connection with functools.partial
+    so the batched-range loop doesn't rebuild it on every request.
+    """
+    global _client, _read_fn
+    with _client_lock:
+        if _client is not None and _client.is_socket_open():
+            return _read_fn
+        _client = get_modbus_client()
+        if not _client.connect():
+            _client = None
+            print(f"❌ Failed to connect to Modbus server at {MODBUS_IP}:{MODBUS_PORT}")
+            raise ConnectionException(f"Failed to connect to {MODBUS_IP}:{MODBUS_PORT}")
+        _tune_socket(_client)
+        _read_fn = functools.partial(_client.read_holding_registers, slave=MODBUS_UNIT_ID)
+        return _read_fn
+
+def _tune_socket(client):
+    """Tune the freshly connected socket for the batched small-ADU workload.
+
+    pymodbus enables TCP_NODELAY by default, putting each ~12-byte ADU in
+    its own segment; re-enabling Nagle lets the kernel coalesce the several
+    range reads a tick now issues. The buffers are widened so a full tick's
+    worth of traffic never blocks on a syscall.
+    """
+    try:
+        sock = client.socket
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+    except (AttributeError, OSError):
+        pass # Transport without a raw socket; leave pymodbus defaults
+
+def _reset_client():
+    """Drop the shared client so the next read attempts a fresh connection."""
+    global _client, _read_fn
+    with _client_lock:
+        if _client is not None:
+            try:
+                _client.close()
+            except Exception:
+                pass # Socket may already be gone
+            _client = None
+            _read_fn = None
+
+atexit.register(_reset_client) # Clean shutdown of the persistent connection
 
 def read_modbus_data():
-    all_registers = {} # Use a dictionary to store registers by address
-    client = None # Initialize client to None
-
     try:
-        client = get_modbus_client()
-        if not client.connect():
-             print(f"❌ Failed to connect to Modbus server at {MODBUS_IP}:{MODBUS_PORT}")
-             raise ConnectionException(f"Failed to connect to {MODBUS_IP}:{MODBUS_PORT}")
-        else:
-             pass # Connection successful
-
-        # --- Read all necessary registers based on MIN/MAX_ADDRESS_TO_READ ---
-        # We need to read from the lowest defined address up to the highest defined address.
+        read_holding = _get_connected_read_fn()
 
-        start_address = MIN_ADDRESS_TO_READ # Starts at 28 based on config
-        registers_read = {}
-        highest_address_needed = MAX_ADDRESS_TO_READ
+        # --- Read the precomputed contiguous ranges of configured addresses ---
+        # Each range is one read_holding_registers request; sparse gaps between
+        # ranges are skipped entirely instead of being read and discarded.
+        # Responses land in a contiguous uint16 buffer spanning MIN..MAX so the
+        # sign conversion below is one vectorized pass.
 
-        while start_address <= highest_address_needed:
-             count = min(MAX_READ_COUNT, highest_address_needed - start_address + 1)
-             if count <= 0: break
+        raw_u16 = np.zeros(_BUFFER_LEN, dtype=np.uint16)
+        seen = np.zeros(_BUFFER_LEN, dtype=bool)
 
+        for start_address, count in READ_RANGES:
              # Ensure we are using HOLDING registers
              #logging.info(f"Attempting Modbus read: Function=read_holding_registers, Start Address={start_address}, Count={count}")
              # *** Use read_holding_registers ***
-             response = client.read_holding_registers(start_address, count=count)
+             response = read_holding(start_address, count=count)
 
              if response.isError():
                  exception_code = getattr(response, 'exception_code', None)
@@ -69,50 +131,43 @@ def read_modbus_data():
                  logging.warning(f"⚠️ Modbus Warning: No registers returned or attribute missing for address {start_address} (count {count}). Response: {response}")
                  pass # Continue if no registers returned
              else:
-                 # Store the read registers with their correct addresses
-                 for i, value in enumerate(response.registers):
-                     current_address = start_address + i
-                     registers_read[current_address] = value
-                     # logging.debug(f"  Read Addr {current_address}: {value}") # Use debug level
-
-             # Move to the next chunk
-             start_address += count
-
-
-        # --- Map register values to variable names using REGISTER_CONFIG ---
-        data_dict = {}
-        # print("Mapping registers to variable names using REGISTER_CONFIG...")
-        for address, reg_info in REGISTER_CONFIG['by_address'].items():
-            if address in registers_read:
-                raw_value = registers_read[address]
-                data_type = reg_info.get('dataType') # Get the dataType from config
-
-                # Convert to signed 16-bit integer if dataType indicates it
-                # Ensure your YAML config uses one of these dataType strings for signed registers
-                signed_types = ['int16', 'sint16', 'signed', 'short', 'signed_short', 'signed int16']
-                if data_type and data_type.lower() in signed_types:
-                    if raw_value > 32767:  # Max positive for 16-bit signed (2^15 - 1)
-                        # Convert from two's complement
-                        processed_value = raw_value - 65536 # 2^16
-                    else:
-                        processed_value = raw_value
+                 # Store the read registers at their buffer offsets
+                 offset = start_address - MIN_ADDRESS_TO_READ
+                 returned = len(response.registers)
+                 raw_u16[offset:offset + returned] = response.registers
+                 seen[offset:offset + returned] = True
+
+
+        # --- Map register values to variable names (vectorized) ---
+        # Viewing the uint16 buffer as int16 performs the two's-complement
+        # conversion for every register in one pass; is_signed selects which
+        # interpretation each register gets, and the precomputed buffer
+        # positions gather every configured register at once. 32-bit values
+        # spanning two registers are still not covered here.
+        positions = _SOA['positions']
+        values = np.where(_SOA['is_signed'],
+                          raw_u16.view(np.int16)[positions],
+                          raw_u16[positions].astype(np.int32))
+        read_ok = seen[positions]
+
+        if read_ok.all():
+            # Steady state: every configured register was read
+            data_dict = dict(zip(_SOA['names'], values.tolist()))
+        else:
+            data_dict = {}
+            for name, value, ok in zip(_SOA['names'], values.tolist(), read_ok.tolist()):
+                if ok:
+                    data_dict[name] = value
                 else:
-                    # For other types (e.g., 'uint16', 'float', or if dataType is None/unspecified),
-                    # pass the raw value. Scaling for floats is handled in live_data.py.
-                    # Note: 32-bit floats/integers would require reading two registers and combining them,
-                    # which is a more complex case not covered by this specific change.
-                    processed_value = raw_value
-
-                data_dict[reg_info['name']] = processed_value
-            else:
-                # Handle cases where a defined register wasn't read (e.g., read error, address gap)
-                print(f"⚠️ Warning: Register '{reg_info['name']}' (Address {address}) defined but not found in read data.")
-                data_dict[reg_info['name']] = None # Or some other indicator
+                    # Defined register wasn't read (e.g., read error, address gap)
+                    print(f"⚠️ Warning: Register '{name}' defined but not found in read data.")
+                    data_dict[name] = None # Or some other indicator
 
         return data_dict
 
     except ConnectionException as ce:
         print(f"❌ Modbus Connection Error: {ce}")
+        _reset_client() # Force a reconnect on the next tick
         return {}
     except Exception as e:
         # Log the full error for better diagnosis
@@ -120,10 +175,6 @@ def read_modbus_data():
         print(f"❌ Modbus Error in read_modbus_data: {e}")
         # print(traceback.format_exc()) # Optional: print full traceback
         return {}
-    finally:
-        if client and client.is_socket_open():
-            client.close()
-            #print("Modbus connection closed.") # Confirm closure
 
 # Optional: Function to generate variable_mapping.py if still needed elsewhere
 def generate_variable_mapping_file():
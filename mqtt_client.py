@@ -1,12 +1,46 @@
-import json
 import logging
+import operator
 import os
+import queue
+import socket
+import ssl
 from datetime import datetime
-from threading import Lock
+from threading import Condition, Event, Lock, Thread, local
+import orjson
 import paho.mqtt.client as mqtt
-from typing import Dict, Any, Optional
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+import zstandard as zstd
+from typing import Dict, Any
+from timezone_config import set_timezone
 import time
 
+# Compressor instances are not thread-safe, and _encode_payload runs on the
+# batch-drain worker and publish_many callers concurrently - so each thread
+# keeps its own, reused across that thread's publishes to amortize the setup
+# cost.
+_zstd_local = local()
+
+def _get_compressor():
+    compressor = getattr(_zstd_local, 'compressor', None)
+    if compressor is None:
+        compressor = _zstd_local.compressor = zstd.ZstdCompressor(level=3)
+    return compressor
+
+# zstd frame magic number; marks a compressed payload for v3 subscribers
+# (v5 connections also get an explicit ContentType property)
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Accepted truthy spellings for boolean env vars
+_TRUTHY = frozenset(('true', '1', 'yes', 'on'))
+
+# Hoisted so the per-sensor loop doesn't re-resolve the module attribute
+_OK = mqtt.MQTT_ERR_SUCCESS
+
+# Seconds before an unconfirmed mid is presumed lost (e.g. dropped across a
+# reconnect) and purged from the inflight set
+_INFLIGHT_TTL_SECS = 60.0
+
 class MQTTUploader:
     """
     MQTT Client for uploading sensor data to an MQTT broker.
@@ -49,19 +83,23 @@ class MQTTUploader:
         self.ws_path = os.getenv('MQTT_WS_PATH', '/mqtt') # Default /mqtt if not set
         
         # TLS Configuration from environment variables
-        self.use_tls = os.getenv('MQTT_USE_TLS', 'false').lower() in ('true', '1', 'yes', 'on')
+        self.use_tls = os.getenv('MQTT_USE_TLS', 'false').lower() in _TRUTHY
         self.tls_ca_certs = os.getenv('MQTT_TLS_CA_CERTS')
         self.tls_certfile = os.getenv('MQTT_TLS_CERTFILE')
         self.tls_keyfile = os.getenv('MQTT_TLS_KEYFILE')
-        self.tls_insecure = os.getenv('MQTT_TLS_INSECURE', 'false').lower() in ('true', '1', 'yes', 'on')
+        self.tls_insecure = os.getenv('MQTT_TLS_INSECURE', 'false').lower() in _TRUTHY
         
+        # Protocol version: v5 by default (reason codes, topic aliases);
+        # MQTT_PROTOCOL=311 falls back for brokers without v5 support
+        self.protocol = mqtt.MQTTv5 if os.getenv('MQTT_PROTOCOL', '5') == '5' else mqtt.MQTTv311
+
         # MQTT client setup
         if self.transport == "websockets":
             logging.info("MQTT transport protocol set to WebSockets.")
-            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id, transport="websockets")
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id, protocol=self.protocol, transport="websockets")
         else:
             logging.info("MQTT transport protocol set to TCP (default).")
-            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id) # Defaults to TCP
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id, protocol=self.protocol) # Defaults to TCP
 
         self.client.on_connect = self._on_connect
         self.client.on_disconnect = self._on_disconnect
@@ -74,101 +112,446 @@ class MQTTUploader:
         # Connection state
         self.is_connected = False
         self._connection_lock = Lock()
+        self._connected_event = Event() # Set by _on_connect on success or refusal
+        self._connect_error = False # Distinguishes broker refusal from timeout
+        self._net_thread = None # Dedicated loop_forever() network thread
+        # TCP_QUICKACK is Linux-only and reset by the kernel after each recv
+        self._quickack = self.transport == 'tcp' and hasattr(socket, 'TCP_QUICKACK')
         
         # QoS settings
         self.qos_level = int(os.getenv('MQTT_QOS_LEVEL', '1'))  # 0: at most once, 1: at least once, 2: exactly once
         
         # Enable/disable MQTT publishing
-        self.enabled = os.getenv('MQTT_ENABLED', 'true').lower() in ('true', '1', 'yes', 'on')
+        self.enabled = os.getenv('MQTT_ENABLED', 'true').lower() in _TRUTHY
+
+        # Optional per-sensor publishing, frozen here so the publish hot path
+        # never re-reads the environment
+        self.publish_individual = os.getenv('MQTT_PUBLISH_INDIVIDUAL', 'false').lower() in _TRUTHY
+
+        # Payload compression: bulk payloads over the threshold are
+        # zstd-compressed before publishing
+        self.compress_enabled = os.getenv('MQTT_COMPRESS', 'true').lower() in _TRUTHY
+        self.compress_min_bytes = int(os.getenv('MQTT_COMPRESS_MIN_BYTES', '1024'))
+
+        # Upper bound on a single publish_many payload before it is split
+        self.max_payload_bytes = int(os.getenv('MQTT_MAX_PAYLOAD_BYTES', '262144'))
+
+        # Publish-side batching: snapshots go onto a bounded queue and a
+        # daemon worker drains, encodes and publishes them, so serialization
+        # and the paho enqueue happen off the caller's thread and queue.Full
+        # gives producers natural backpressure. A lone snapshot keeps the
+        # original flat shape on bulk_topic; only genuine multi-snapshot
+        # drains use the {"batch": [...]} envelope on <bulk_topic>/batch.
+        # (MQTT_TX_BATCH_SIZE is distinct from app.py's MQTT_BATCH_SIZE,
+        # which governs app-level sample accumulation.)
+        self.batch_enabled = os.getenv('MQTT_BATCH_ENABLED', 'true').lower() in _TRUTHY
+        self.batch_size = int(os.getenv('MQTT_TX_BATCH_SIZE', '64'))
+        self.batch_flush_secs = int(os.getenv('MQTT_FLUSH_INTERVAL_MS', '200')) / 1000.0
+        self.batch_topic = f"{self.bulk_topic}/batch"
+        self._tx_q = queue.Queue(maxsize=int(os.getenv('MQTT_TX_QUEUE_SIZE', '1000')))
+        if self.batch_enabled:
+            Thread(target=self._drain_loop, name='mqtt-batch-drain', daemon=True).start()
+
+        # In-flight publish tracking: publishes return immediately and
+        # _on_publish confirms them asynchronously; await_inflight() is the
+        # backpressure valve when too many confirmations are outstanding
+        self._inflight = {} # mid -> enqueue time (monotonic)
+        self._inflight_cv = Condition()
+        self._early_acks = set() # mids confirmed before _track_publish ran
+        self._last_confirmed_mid = 0 # Watermark for health metrics
+        self.max_inflight = int(os.getenv('MQTT_MAX_INFLIGHT', '100'))
+
+        # Hot-path serialization: orjson emits bytes directly (paho accepts
+        # them, skipping its internal str.encode); the constant payload keys
+        # are built once here instead of per publish
+        self._encode = orjson.dumps
+        self._static_payload = {'device_id': self.client_id}
+        self._topic_cache: Dict[str, str] = {} # sensor name -> per-sensor topic
+
+        # MQTT v5 PUBLISH properties: each topic gets an alias up to the
+        # broker's CONNACK limit (TopicAliasMaximum), and compressed payloads
+        # carry a ContentType. Built once per (topic, compressed) pair and
+        # reset on every connection, since aliases are per-connection state.
+        self._alias_max = 0
+        self._alias_ids: Dict[str, int] = {} # topic -> assigned alias
+        self._pub_props: Dict[tuple, Properties] = {} # (topic, compressed) -> cached properties
+
+        # Snapshot of the sensor key set, taken on first publish: a single
+        # C-level itemgetter then gathers every value per publish instead of
+        # iterating .items() with per-key comparisons. Only worthwhile for
+        # callers with a stable key set (full snapshots); the first mismatch
+        # disables the fast path for good rather than re-snapshotting every
+        # publish of a delta stream.
+        self._known_keys = None
+        self._pack = None
+        self._pack_disabled = False
+
+        # The shared client's internal queue is the batching/backpressure
+        # point for every caller in the process
+        self.client.max_inflight_messages_set(self.max_inflight)
+        self.client.max_queued_messages_set(int(os.getenv('MQTT_MAX_QUEUED', '10000')))
+
+        # Exponential backoff on reconnects; without this paho retries at a
+        # fixed 1s, and anything near 0 would hammer a recovering broker
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+        # Transport/TLS branches are evaluated once; reconnects just call this
+        self._do_connect = self._build_connect_fn()
         
         logging.info(f"MQTT Uploader initialized - Broker: {self.broker_host}:{self.broker_port}, Base Topic: {self.base_topic}, Enabled: {self.enabled}")
     
+    def _tune_socket(self):
+        """Tune the broker socket for small, latency-sensitive PUBLISH frames.
+
+        Paho leaves TCP_NODELAY unset, so the small frames this uploader
+        sends can sit in the kernel waiting for more bytes or the ~40ms
+        coalescing timer. The send buffer is widened so a full batch fits
+        without a partial write, and on Linux TCP_QUICKACK acks broker
+        traffic immediately instead of delaying up to 40ms. Reapplied from
+        _on_connect because paho recreates the socket on reconnect.
+        """
+        if self.transport != 'tcp':
+            return
+        try:
+            sock = self.client.socket()
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 262144)
+                self._set_quickack(sock)
+        except (AttributeError, OSError):
+            pass # Socket already gone or wrapped; keep paho defaults
+
+    def _set_quickack(self, sock=None):
+        """Re-enable TCP_QUICKACK (Linux clears it again after each recv)."""
+        if not self._quickack:
+            return
+        try:
+            if sock is None:
+                sock = self.client.socket()
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        except (AttributeError, OSError):
+            pass
+
     def _on_connect(self, client, userdata, flags, reason_code, properties=None):
         """Callback for when the client receives a CONNACK response from the server."""
         if reason_code == 0:
             self.is_connected = True
+            self._connect_error = False
+            # Aliases never survive a connection; re-learn the broker's limit
+            self._alias_ids.clear()
+            self._pub_props.clear()
+            self._alias_max = getattr(properties, 'TopicAliasMaximum', 0) if properties is not None else 0
+            self._tune_socket()
             logging.info(f"✅ Connected to MQTT broker {self.broker_host}:{self.broker_port}")
         else:
             self.is_connected = False
+            self._connect_error = True
             logging.error(f"❌ Failed to connect to MQTT broker. Reason code: {reason_code}")
+        # Wake the waiter in connect() for success and refusal alike
+        self._connected_event.set()
     
     def _on_disconnect(self, client, userdata, flags, reason_code, properties=None):
         """Callback for when the client disconnects from the server."""
         self.is_connected = False
+        # Re-arm the event so connect() callers block until the network
+        # thread's reconnect produces the next CONNACK
+        self._connected_event.clear()
         if reason_code != 0:
             logging.warning(f"⚠️ Unexpected MQTT disconnection. Reason code: {reason_code}")
         else:
             logging.info("📡 Disconnected from MQTT broker")
     
     def _on_publish(self, client, userdata, mid, reason_code=None, properties=None):
-        """Callback for when a message is published."""
+        """Callback for when a message is published (confirmed by the broker)."""
+        # Each broker ack we just received cleared QUICKACK; re-arm it so the
+        # next inbound segment is acked without the delayed-ack timer
+        self._set_quickack()
+        with self._inflight_cv:
+            sent_at = self._inflight.pop(mid, None)
+            if sent_at is None:
+                # paho may deliver the ack before publish() has returned to
+                # the caller; remember the mid so _track_publish doesn't
+                # insert an entry that no callback will ever clear
+                self._early_acks.add(mid)
+                if len(self._early_acks) > 1000:
+                    self._early_acks.clear() # Defensive bound; entries are normally consumed
+            if mid > self._last_confirmed_mid:
+                self._last_confirmed_mid = mid
+            self._inflight_cv.notify_all()
+
         if reason_code and reason_code != 0:
             logging.error(f"❌ Failed to publish message {mid}. Reason code: {reason_code}")
+        elif sent_at is not None:
+            logging.debug(f"📤 Message {mid} confirmed after {time.monotonic() - sent_at:.3f}s")
         else:
             logging.debug(f"📤 Message {mid} published successfully")
+
+    def _track_publish(self, result):
+        """Record an accepted publish so _on_publish can confirm it asynchronously."""
+        if result.rc == _OK:
+            with self._inflight_cv:
+                if result.mid in self._early_acks:
+                    # Confirmed before we got here; nothing left to track
+                    self._early_acks.discard(result.mid)
+                else:
+                    self._inflight[result.mid] = time.monotonic()
+
+    def _purge_stale_inflight(self):
+        """Drop unconfirmed mids older than the TTL. Caller holds _inflight_cv.
+
+        QoS 1 acks can be lost across reconnects without a callback firing;
+        without a purge those mids accumulate until the high-water mark is
+        permanently exceeded and every await_inflight stalls to its timeout.
+        """
+        cutoff = time.monotonic() - _INFLIGHT_TTL_SECS
+        stale = [mid for mid, sent_at in self._inflight.items() if sent_at < cutoff]
+        for mid in stale:
+            del self._inflight[mid]
+        if stale:
+            logging.warning("⚠️ Purged %d MQTT publishes unconfirmed after %.0fs", len(stale), _INFLIGHT_TTL_SECS)
+
+    def await_inflight(self, max_inflight: int = None, timeout: float = 5.0) -> bool:
+        """Block only while more than max_inflight publishes await confirmation.
+
+        The publish paths never wait on individual acks; this is the
+        high-water-mark backpressure valve that keeps the unconfirmed set
+        (and its memory) bounded during bursts.
+
+        Returns:
+            bool: True once under the high-water mark, False on timeout
+        """
+        high_water = self.max_inflight if max_inflight is None else max_inflight
+        deadline = time.monotonic() + timeout
+        with self._inflight_cv:
+            self._purge_stale_inflight()
+            while len(self._inflight) > high_water:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._inflight_cv.wait(remaining):
+                    return False
+                self._purge_stale_inflight()
+        return True
     
-    def connect(self) -> bool:
+    def _encode_payload(self, payload_json) -> bytes:
+        """Encode an outbound JSON payload, compressing it when large.
+
+        Payloads over MQTT_COMPRESS_MIN_BYTES are zstd-compressed; these
+        numeric JSON dicts are highly redundant and typically shrink 3-10x.
+        On v5 connections _publish marks compressed payloads with a
+        ContentType of application/json+zstd; the zstd frame magic number
+        (0x28B52FFD) remains the signal for v3 fallback connections, which
+        have no content-type property.
+        """
+        payload = payload_json.encode('utf-8') if isinstance(payload_json, str) else payload_json
+        if self.compress_enabled and len(payload) > self.compress_min_bytes:
+            payload = _get_compressor().compress(payload)
+        return payload
+
+    def _buffer_for_batch(self, payload: Dict[str, Any]) -> bool:
+        """Hand a snapshot to the drain worker; refuses (backpressure) when full."""
+        try:
+            self._tx_q.put_nowait(payload)
+            return True
+        except queue.Full:
+            logging.warning("⚠️ MQTT transmit queue full; dropping snapshot")
+            return False
+
+    def _drain_loop(self):
+        """Daemon worker: drain queued snapshots and publish them in batches.
+
+        Blocks for the flush interval waiting for the first snapshot, then
+        keeps accumulating until the batch fills or the interval elapses, so
+        each wakeup publishes as much as possible in one message.
+        """
+        while True:
+            try:
+                batch = [self._tx_q.get(timeout=self.batch_flush_secs)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.batch_flush_secs
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._tx_q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._publish_batch(batch)
+            except Exception as e:
+                logging.error(f"❌ Error publishing MQTT batch: {e}")
+
+    def _publish_batch(self, batch) -> bool:
+        """Publish drained snapshots, preserving the flat wire contract.
+
+        A single snapshot - the common case at the default 5s tick - goes to
+        bulk_topic in the original flat-dict shape, so existing subscribers
+        see no difference with batching enabled. Only genuine multi-snapshot
+        drains use the {"batch": [...]} envelope on <bulk_topic>/batch.
+        """
+        if not batch:
+            return True
+
+        self.await_inflight() # Backpressure only when confirmations lag badly
+        if len(batch) == 1:
+            topic = self.bulk_topic
+            payload = self._encode_payload(self._encode(batch[0]))
+        else:
+            topic = self.batch_topic
+            payload = self._encode_payload(self._encode({"batch": batch}))
+        result = self._publish(topic, payload)
+        if result.rc != _OK:
+            logging.error(f"❌ Failed to publish batch of {len(batch)}. Error code: {result.rc}")
+            return False
+        self._track_publish(result)
+        logging.debug("📤 Published batch of %d snapshots to %s", len(batch), topic)
+        return True
+
+    def _publish(self, topic: str, payload) -> mqtt.MQTTMessageInfo:
+        """Publish through the shared client, attaching v5 PUBLISH properties.
+
+        Two properties are managed here on v5 connections: a topic alias
+        (mapping the topic string to a 2-byte integer at the broker; paho's
+        publish() rejects empty topics, so the string still rides along on
+        every frame for now, and topics beyond the broker's advertised
+        maximum simply go without), and a ContentType of
+        application/json+zstd on compressed payloads so v5 subscribers need
+        not probe the frame magic. Properties are cached per
+        (topic, compressed) pair and rebuilt on each connection.
+        """
+        properties = None
+        if self.protocol == mqtt.MQTTv5:
+            compressed = isinstance(payload, bytes) and payload.startswith(_ZSTD_MAGIC)
+            key = (topic, compressed)
+            properties = self._pub_props.get(key)
+            if properties is None:
+                properties = Properties(PacketTypes.PUBLISH)
+                if compressed:
+                    properties.ContentType = 'application/json+zstd'
+                alias = self._alias_ids.get(topic)
+                if alias is None and self._alias_max and len(self._alias_ids) < self._alias_max:
+                    alias = len(self._alias_ids) + 1
+                    self._alias_ids[topic] = alias
+                if alias is not None:
+                    properties.TopicAlias = alias
+                self._pub_props[key] = properties
+        return self.client.publish(topic, payload, qos=self.qos_level, properties=properties)
+
+    def _build_connect_fn(self):
+        """Partially evaluate the transport/TLS branches into one callable.
+
+        Transport and TLS choice are fixed at init, so the WebSocket and TLS
+        configuration runs exactly once here (it also must not be repeated -
+        paho rejects a second tls_set). The returned callable does only the
+        actual connect and is what every (re)connection invokes.
+        """
+        # Order is important for WSS: ws_set_options() before tls_set()
+        if self.transport == "websockets":
+            logging.info(f"Configuring WebSocket options. Path: {self.ws_path}")
+            self.client.ws_set_options(path=self.ws_path)
+
+        if self.use_tls:
+            ca_certs_to_use = self.tls_ca_certs
+            if self.tls_ca_certs:
+                if not os.path.isfile(self.tls_ca_certs):
+                    logging.warning(f"⚠️ Specified MQTT_TLS_CA_CERTS ('{self.tls_ca_certs}') is not a valid file. Falling back to system CAs.")
+                    ca_certs_to_use = None
+                else:
+                    logging.info(f"ℹ️ Using specified MQTT_TLS_CA_CERTS: {self.tls_ca_certs}")
+            else:
+                logging.info("ℹ️ MQTT_TLS_CA_CERTS is not set. Using system CAs for TLS.")
+
+            logging.info(f"🔒 Attempting TLS configuration for MQTT connection...")
+            # One SSLContext, kept for the life of the uploader: the stdlib
+            # context caches TLS 1.3 session tickets, so reconnects through
+            # the same context resume the session instead of paying a full
+            # handshake. OP_NO_TICKET is cleared explicitly in case a
+            # hardened default disabled tickets.
+            self._tls_context = ssl.create_default_context(cafile=ca_certs_to_use)
+            self._tls_context.options &= ~ssl.OP_NO_TICKET
+            if self.tls_certfile:
+                self._tls_context.load_cert_chain(self.tls_certfile, self.tls_keyfile)
+            self.client.tls_set_context(self._tls_context)
+            if self.tls_insecure:
+                logging.warning("⚠️ MQTT_TLS_INSECURE is true. Server hostname verification is disabled. NOT RECOMMENDED.")
+                self.client.tls_insecure_set(True)
+
+        # Connection banner, precomputed once
+        if self.transport == "websockets":
+            connection_type_log = "WSS" if self.use_tls else "WS"
+            log_path = self.ws_path
+        else:
+            connection_type_log = "TLS/TCP" if self.use_tls else "TCP"
+            log_path = ""
+        banner = f"🔗 Connecting to MQTT broker {self.broker_host}:{self.broker_port}{log_path} ({connection_type_log})..."
+
+        def _do_connect():
+            logging.info(banner)
+            self.client.connect(self.broker_host, self.broker_port, self.keepalive)
+            self._tune_socket()
+
+        return _do_connect
+
+    def connect(self, timeout: float = 10.0) -> bool:
         """
         Connect to the MQTT broker.
-        
+
+        Args:
+            timeout: Seconds to wait for the broker's CONNACK
+
         Returns:
             bool: True if connection successful, False otherwise
         """
         if not self.enabled:
             logging.info("MQTT publishing is disabled")
             return False
-            
+
+        # Steady-state fast path: every publish calls connect(), so the
+        # already-connected case is answered with a plain attribute load
+        # instead of a lock round-trip. A stale False merely costs one extra
+        # lock acquire below, never a correctness issue.
+        if self.is_connected:
+            return True
+
         with self._connection_lock:
             if self.is_connected:
                 return True
-            
+
             try:
-                # Order is important for WSS: ws_set_options() before tls_set()
-                if self.transport == "websockets":
-                    logging.info(f"Configuring WebSocket options. Path: {self.ws_path}")
-                    self.client.ws_set_options(path=self.ws_path)
-
-                if self.use_tls:
-                    ca_certs_to_use = self.tls_ca_certs
-                    if self.tls_ca_certs:
-                        if not os.path.isfile(self.tls_ca_certs):
-                            logging.warning(f"⚠️ Specified MQTT_TLS_CA_CERTS ('{self.tls_ca_certs}') is not a valid file. Falling back to system CAs.")
-                            ca_certs_to_use = None
-                        else:
-                            logging.info(f"ℹ️ Using specified MQTT_TLS_CA_CERTS: {self.tls_ca_certs}")
-                    else:
-                        logging.info("ℹ️ MQTT_TLS_CA_CERTS is not set. Using system CAs for TLS.")
-                    
-                    logging.info(f"🔒 Attempting TLS configuration for MQTT connection...")
-                    self.client.tls_set(
-                        ca_certs=ca_certs_to_use,
-                        certfile=self.tls_certfile,
-                        keyfile=self.tls_keyfile
-                    )
-                    if self.tls_insecure:
-                        logging.warning("⚠️ MQTT_TLS_INSECURE is true. Server hostname verification is disabled. NOT RECOMMENDED.")
-                        self.client.tls_insecure_set(True)
-                
-                # Determine connection type for logging
-                connection_type_log = "TCP"
-                if self.transport == "websockets":
-                    connection_type_log = "WSS" if self.use_tls else "WS"
-                elif self.use_tls:
-                    connection_type_log = "TLS/TCP"
-                
-                log_path = self.ws_path if self.transport == "websockets" else ""
-                logging.info(f"🔗 Connecting to MQTT broker {self.broker_host}:{self.broker_port}{log_path} ({connection_type_log})...")
-
-                self.client.connect(self.broker_host, self.broker_port, self.keepalive)
-                self.client.loop_start()  # Start background network loop
-                  # Wait for connection with timeout
-                timeout = 10  # seconds
-                start_time = time.time()
-                while not self.is_connected and (time.time() - start_time) < timeout:
-                    time.sleep(0.1)
-                
-                if self.is_connected:
+                # While the network thread is alive, loop_forever() owns
+                # reconnection (with the configured backoff); issuing another
+                # client.connect() from this thread would race its socket
+                # replacement. Just wait for its next CONNACK - _on_disconnect
+                # re-armed the event when the connection dropped.
+                if self._net_thread is not None and self._net_thread.is_alive():
+                    if self._connected_event.wait(timeout=timeout) and self.is_connected:
+                        return True
+                    logging.error("❌ Timed out waiting for MQTT reconnect")
+                    return False
+
+                # First connection (or the network thread has exited): drive
+                # the handshake ourselves, then run the network loop via
+                # loop_forever() on our own daemon thread rather than
+                # loop_start(): loop_forever blocks in select() until the
+                # socket (or paho's wake pipe) has work, instead of
+                # loop_start's fixed short-timeout wakeups, and it handles
+                # reconnects internally with the backoff set above.
+                self._connected_event.clear()
+                self._do_connect()
+                self._net_thread = Thread(
+                    target=self.client.loop_forever,
+                    kwargs={'retry_first_connection': True},
+                    name='mqtt-network', daemon=True)
+                self._net_thread.start()
+
+                # Wait for the CONNACK callback; _on_connect sets the event on
+                # success and refusal alike, so no polling is needed
+                if self._connected_event.wait(timeout=timeout) and self.is_connected:
                     return True
+                elif self._connect_error:
+                    logging.error("❌ Broker refused the connection")
+                    return False
                 else:
                     logging.error("❌ Connection timeout")
                     return False
@@ -180,8 +563,11 @@ class MQTTUploader:
     def disconnect(self):
         """Disconnect from the MQTT broker."""
         if self.is_connected:
-            self.client.loop_stop()
+            # A clean disconnect makes loop_forever() return, ending the
+            # network thread; join briefly so shutdown doesn't race it
             self.client.disconnect()
+            if self._net_thread is not None:
+                self._net_thread.join(timeout=5)
             logging.info("📡 Disconnected from MQTT broker")
     
     def publish_sensor_data(self, sensor_data: Dict[str, Any]) -> bool:
@@ -203,22 +589,64 @@ class MQTTUploader:
             logging.error("❌ Cannot publish: Not connected to MQTT broker")
             return False
         
-        logging.info(f"✅ MQTT connected, proceeding with publish to {self.broker_host}:{self.broker_port}")
-        
+        # %-style args defer formatting until a handler actually accepts the
+        # record, so these cost nothing when the level filters them out
+        logging.debug("✅ MQTT connected, proceeding with publish to %s:%s", self.broker_host, self.broker_port)
+
         try:
-            # Prepare timestamp
+            # A list is a pre-batched set of samples: publish as one JSON array
+            if isinstance(sensor_data, list):
+                payload = self._encode_payload(self._encode(sensor_data))
+                logging.debug("📤 Publishing batch of %d samples to MQTT topic: %s", len(sensor_data), self.bulk_topic)
+                result = self._publish(self.bulk_topic, payload)
+                if result.rc != _OK:
+                    logging.error(f"❌ Failed to publish batch data. Error code: {result.rc}")
+                    return False
+                self._track_publish(result)
+                return True
+
+            # Prepare timestamp: formatted once here and shared by the bulk
+            # payload and every individual payload below, so a publish is one
+            # clock read and one strftime regardless of sensor count (and the
+            # individual messages can no longer carry a later stamp than the
+            # bulk one they belong to)
             timestamp = sensor_data.get('timestamp')
             if isinstance(timestamp, str):
                 # If timestamp is already ISO string, use it
                 timestamp_str = timestamp
             else:
                 # If timestamp is datetime object or None, convert to ISO string
-                timestamp_str = datetime.now().isoformat() if timestamp is None else timestamp.isoformat()
+                timestamp_str = datetime.now(tz=set_timezone).isoformat() if timestamp is None else timestamp.isoformat()
             
             # Publish bulk data message
             # The sensor_data comes directly from live_data.py (flat structure with original casing)
             # We need to create the same structure as the /live-data endpoint
-            bulk_payload = {k: v for k, v in sensor_data.items() if k != 'timestamp' and v is not None}
+            if self._pack is not None:
+                try:
+                    # Steady state: one itemgetter call gathers all values in
+                    # C. The length check rejects supersets of the snapshot
+                    # (which itemgetter would silently truncate); missing keys
+                    # raise.
+                    if len(sensor_data) - ('timestamp' in sensor_data) != len(self._known_keys):
+                        raise KeyError
+                    values = self._pack(sensor_data)
+                    bulk_payload = {k: v for k, v in zip(self._known_keys, values) if v is not None}
+                except KeyError:
+                    # Key set changed, so this caller's keys are not stable
+                    # (delta publishes vary every tick): disable the fast path
+                    # instead of thrashing through snapshot/raise cycles
+                    self._known_keys = self._pack = None
+                    self._pack_disabled = True
+                    bulk_payload = {k: v for k, v in sensor_data.items() if k != 'timestamp' and v is not None}
+            else:
+                if self._known_keys is None and not self._pack_disabled:
+                    # Snapshot needs at least two keys: itemgetter with one key
+                    # returns the bare value, which zip would mangle
+                    keys = tuple(k for k in sensor_data if k != 'timestamp')
+                    if len(keys) >= 2:
+                        self._known_keys = keys
+                        self._pack = operator.itemgetter(*keys)
+                bulk_payload = {k: v for k, v in sensor_data.items() if k != 'timestamp' and v is not None}
             
             # Add timestamp if it exists
             if 'timestamp' in sensor_data:
@@ -227,23 +655,27 @@ class MQTTUploader:
             if 'device_id' in sensor_data:
                 bulk_payload['device_id'] = sensor_data['device_id']
             
+            # Batching enabled: buffer the snapshot and let the flush publish
+            # it; the per-sensor loop below is skipped entirely in this mode
+            if self.batch_enabled:
+                return self._buffer_for_batch(bulk_payload)
+
             # bulk_topic = f\"{self.base_topic}/data/bulk\" # Old line
-            payload_json = json.dumps(bulk_payload)
-            logging.info(f"📤 Publishing to MQTT topic: {self.bulk_topic}")
-            logging.info(f"📤 Payload JSON length: {len(payload_json)} characters")
-            logging.debug(f"📤 Full payload: {payload_json}")
-            
-            result = self.client.publish(self.bulk_topic, payload_json, qos=self.qos_level)
-            
-            if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            payload_json = self._encode(bulk_payload)
+            logging.debug("📤 Publishing to MQTT topic: %s, payload len=%d", self.bulk_topic, len(payload_json))
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(f"📤 Full payload: {payload_json}")
+
+            result = self._publish(self.bulk_topic, self._encode_payload(payload_json))
+
+            if result.rc != _OK:
                 logging.error(f"❌ Failed to publish bulk data. Error code: {result.rc}")
                 return False
+            self._track_publish(result)
             
             
             # Optionally publish individual sensor values
-            publish_individual = os.getenv('MQTT_PUBLISH_INDIVIDUAL', 'false').lower() in ('true', '1', 'yes', 'on')
-            
-            if publish_individual:
+            if self.publish_individual:
                 success_count = 0
                 total_count = 0
                 
@@ -252,18 +684,23 @@ class MQTTUploader:
                         continue
                     
                     total_count += 1
-                    individual_topic = f"{self.base_topic}/sensors/{sensor_name}"
-                    
+                    # Sensor names are a stable set, so the topic string is
+                    # built once per name instead of per publish
+                    individual_topic = self._topic_cache.get(sensor_name)
+                    if individual_topic is None:
+                        individual_topic = self._topic_cache.setdefault(
+                            sensor_name, f"{self.base_topic}/sensors/{sensor_name}")
+
                     individual_payload = {
+                        **self._static_payload,
                         'timestamp': timestamp_str,
                         'value': value,
-                        'sensor': sensor_name,
-                        'device_id': self.client_id
+                        'sensor': sensor_name
                     }
+
+                    result = self._publish(individual_topic, self._encode(individual_payload))
                     
-                    result = self.client.publish(individual_topic, json.dumps(individual_payload), qos=self.qos_level)
-                    
-                    if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                    if result.rc == _OK:
                         success_count += 1
                     else:
                         logging.error(f"❌ Failed to publish {sensor_name}. Error code: {result.rc}")
@@ -276,13 +713,60 @@ class MQTTUploader:
             logging.error(f"❌ Error publishing sensor data to MQTT: {e}")
             return False
     
-    def publish_status_message(self, status: str, message: str = None) -> bool:
+    def publish_many(self, samples: list) -> int:
+        """
+        Publish a burst of samples as the fewest possible MQTT messages.
+
+        Built for callers flushing an accumulated backlog (e.g. samples
+        buffered across a broker outage): the whole list goes out as one
+        {"samples": [...]} publish, split in half recursively whenever the
+        encoded payload exceeds MQTT_MAX_PAYLOAD_BYTES, instead of paying
+        the full publish path once per sample.
+
+        Args:
+            samples: List of sensor-data dictionaries
+
+        Returns:
+            int: Number of samples successfully handed to the client
+        """
+        if not self.enabled:
+            return len(samples) # Match publish_sensor_data: don't block data flow
+        if not samples:
+            return 0
+        if not self.connect():
+            logging.error("❌ Cannot publish batch: Not connected to MQTT broker")
+            return 0
+
+        sent = 0
+        pending = [list(samples)]
+        while pending:
+            chunk = pending.pop()
+            payload_json = self._encode({"samples": chunk})
+            if len(payload_json) > self.max_payload_bytes and len(chunk) > 1:
+                # Halve until each piece fits; right half pushed first so the
+                # samples still go out in order
+                mid = len(chunk) // 2
+                pending.append(chunk[mid:])
+                pending.append(chunk[:mid])
+                continue
+            self.await_inflight()
+            result = self._publish(self.bulk_topic, self._encode_payload(payload_json))
+            if result.rc == _OK:
+                self._track_publish(result)
+                sent += len(chunk)
+            else:
+                logging.error(f"❌ Failed to publish chunk of {len(chunk)} samples. Error code: {result.rc}")
+        return sent
+
+    def publish_status_message(self, status: str, message: str = None, now_iso: str = None) -> bool:
         """
         Publish a status message to MQTT broker.
         
         Args:
             status: Status level (e.g., 'online', 'offline', 'error', 'warning')
             message: Optional status message
+            now_iso: Optional pre-formatted ISO timestamp, so callers emitting
+                several statuses can share one clock read
             
         Returns:
             bool: True if published successfully, False otherwise
@@ -296,15 +780,15 @@ class MQTTUploader:
         try:
             status_topic = f"{self.base_topic}/status"
             payload = {
-                'timestamp': datetime.now().isoformat(),
+                'timestamp': now_iso or datetime.now(tz=set_timezone).isoformat(),
                 'device_id': self.client_id,
                 'status': status,
                 'message': message
             }
             
-            result = self.client.publish(status_topic, json.dumps(payload), qos=self.qos_level)
+            result = self._publish(status_topic, self._encode(payload))
             
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
+            if result.rc == _OK:
                 return True
             else:
                 logging.error(f"❌ Failed to publish status message. Error code: {result.rc}")
@@ -315,15 +799,9 @@ class MQTTUploader:
             return False
 
 
-# Global MQTT uploader instance
-_mqtt_uploader: Optional[MQTTUploader] = None
-
-def get_mqtt_uploader() -> MQTTUploader:
-    """Get or create the global MQTT uploader instance."""
-    global _mqtt_uploader
-    if _mqtt_uploader is None:
-        _mqtt_uploader = MQTTUploader()
-    return _mqtt_uploader
+# The global uploader instance lives in mqtt_singleton; re-exported here so
+# existing `from mqtt_client import get_mqtt_uploader` imports keep working
+from mqtt_singleton import get_mqtt_uploader
 
 def upload_to_mqtt(sensor_data: Dict[str, Any]) -> bool:
     """
@@ -341,3 +819,20 @@ def upload_to_mqtt(sensor_data: Dict[str, Any]) -> bool:
     except Exception as e:
         logging.error(f"❌ Error in upload_to_mqtt: {e}")
         return False
+
+def upload_to_mqtt_many(samples: list) -> int:
+    """
+    Convenience function to upload a batch of samples to MQTT.
+
+    Args:
+        samples: List of sensor-data dictionaries
+
+    Returns:
+        int: Number of samples successfully handed to the client
+    """
+    try:
+        uploader = get_mqtt_uploader()
+        return uploader.publish_many(samples)
+    except Exception as e:
+        logging.error(f"❌ Error in upload_to_mqtt_many: {e}")
+        return 0
@@ -0,0 +1,28 @@
+"""Process-wide MQTTUploader singleton.
+
+Every caller shares one paho client and one TCP connection: pushing all
+messages through a single socket lets the TCP stack coalesce frames, and
+the lock below guards lazy construction so two threads can never race two
+clients (and two broker connections) into existence.
+
+mqtt_client re-exports get_mqtt_uploader for its legacy importers, so the
+import of MQTTUploader happens inside the accessor - a module-level import
+back into mqtt_client would fail with a partially initialized module
+whenever this module is imported first.
+"""
+import threading
+from typing import Optional
+
+_mqtt_uploader: Optional["MQTTUploader"] = None
+_uploader_lock = threading.Lock()
+
+
+def get_mqtt_uploader() -> "MQTTUploader":
+    """Get or create the global MQTT uploader instance."""
+    global _mqtt_uploader
+    if _mqtt_uploader is None:
+        with _uploader_lock:
+            if _mqtt_uploader is None:
+                from mqtt_client import MQTTUploader
+                _mqtt_uploader = MQTTUploader()
+    return _mqtt_uploader
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""Convert register_config.yaml to register_config.json.
+
+register_config.yaml stays the authoring format; run this at deploy time
+(or from a pre-commit hook) so config_loader can load the JSON conversion
+and skip the YAML parser entirely at startup.
+
+Usage: python scripts/yaml_to_json.py [path/to/register_config.yaml]
+"""
+import json
+import os
+import sys
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+def main():
+    if len(sys.argv) > 1:
+        yaml_path = sys.argv[1]
+    else:
+        yaml_path = os.path.join(os.path.dirname(__file__), '..', 'register_config.yaml')
+    yaml_path = os.path.abspath(yaml_path)
+    json_path = os.path.splitext(yaml_path)[0] + '.json'
+
+    with open(yaml_path, 'r', encoding='utf-8') as f:
+        config = yaml.load(f, Loader=SafeLoader)
+
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+
+    print(f"✅ Converted {yaml_path} -> {json_path}")
+
+
+if __name__ == '__main__':
+    main()